@@ -1,34 +1,74 @@
 # app.py (محدّث)
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import Flask, render_template, request, jsonify, send_from_directory, abort, Response, stream_with_context
 import os
+
+# خيوط Whisper (قبل استيراد faster_whisper): الأنوية الفعلية مقسومة على كل التفريغات المتوازية في كل العمّال
+physical_cores = int(os.getenv("PHYSICAL_CORES", str(max(1, (os.cpu_count() or 2) // 2))))
+whisper_workers = int(os.getenv("WHISPER_WORKERS", "1"))
+web_workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+cpu_threads = int(os.getenv("WHISPER_CPU_THREADS", str(max(1, physical_cores // (whisper_workers * web_workers)))))
+os.environ.setdefault("OMP_NUM_THREADS", str(cpu_threads))
+os.environ.setdefault("MKL_NUM_THREADS", str(cpu_threads))
+
 import json
+import ctranslate2
 from faster_whisper import WhisperModel
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from gtts import gTTS
-from werkzeug.utils import secure_filename
+import io
 import time
+import wave
+import hashlib
+import threading
 import logging
+import struct
+import uuid
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import re
-import difflib
+import functools
+import numpy as np
+from rapidfuzz import process, fuzz
+from werkzeug.security import safe_join
+from flask_compress import Compress
+from text_utils import normalize_arabic, build_automaton, first_match, split_sentences, iter_sentences
+
+# orjson اختياري (pip install orjson): تحليل JSON أسرع بعدة مرات من المكتبة القياسية
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("voice-bot")
 
 app = Flask(__name__)
-UPLOAD_FOLDER = "uploads"
+Compress(app)  # ضغط gzip/brotli لردود JSON و HTML
+# حد أقصى لحجم الرفع: يرفض Werkzeug الطلبات الأكبر أثناء قراءة الجسم (413)
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "10")) * 1024 * 1024
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES
 AUDIO_RESPONSES_FOLDER = "responses"
 
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(AUDIO_RESPONSES_FOLDER, exist_ok=True)
 
+# تقديم الملفات الصوتية من خادم الويب مباشرة (sendfile) بدل قراءتها عبر Python:
+# - خلف nginx: RESPONSES_ACCEL_PREFIX=/_responses مع
+#     location /_responses/ { internal; alias /app/responses/; }
+# - خلف Apache/lighttpd: USE_X_SENDFILE=1
+RESPONSES_ACCEL_PREFIX = os.getenv("RESPONSES_ACCEL_PREFIX", "").rstrip("/")
+app.use_x_sendfile = os.getenv("USE_X_SENDFILE") == "1"
+
 # ---------------- تحميل بيانات الأدوية ----------------
 MEDS_FILE = "medications.json"
 
 def load_medications():
     if os.path.exists(MEDS_FILE):
         try:
-            with open(MEDS_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
+            with open(MEDS_FILE, "rb") as f:
+                raw = f.read()
+            data = orjson.loads(raw) if orjson else json.loads(raw)
             logger.info(f"Loaded medications: {list(data.keys())}")
             return data
         except Exception as e:
@@ -38,25 +78,17 @@ def load_medications():
         logger.warning("medications.json not found.")
         return {}
 
-medications_data = load_medications()
-
-# ---------------- دوال تطبيع النص العربي ----------------
-ARABIC_DIACRITICS = re.compile(r"""
-    [\u0610-\u061A\u064B-\u065F\u0670\u06D6-\u06ED]
-""", re.VERBOSE)
-
-def normalize_arabic(text: str) -> str:
-    if not text:
-        return ""
-    text = text.strip().lower()
-    text = ARABIC_DIACRITICS.sub("", text)
-    text = re.sub(r"[آأإٰ]", "ا", text)
-    text = re.sub(r"ى", "ي", text)
-    text = re.sub(r"ؤ", "و", text)
-    text = re.sub(r"ئ", "ي", text)
-    text = re.sub(r"[^\w\s\u0600-\u06FF]", " ", text)
-    text = re.sub(r"\s+", " ", text).strip()
-    return text
+# ملخص مضغوط للأدوية يُرسل إلى Gemini: الحقول التي يحتاجها الرد فقط (بدون الأسماء البديلة)
+MEDS_SUMMARY_FIELDS = ("الجرعة", "الوقت", "ملاحظات", "dose", "time", "notes")
+
+def summarize_medications(meds: dict) -> str:
+    summary = {}
+    for name, info in meds.items():
+        if isinstance(info, dict):
+            summary[name] = {k: info[k] for k in MEDS_SUMMARY_FIELDS if info.get(k)}
+        else:
+            summary[name] = info
+    return json.dumps(summary, ensure_ascii=False, separators=(",", ":"))
 
 # ---------------- بناء فهرس للأسماء ----------------
 def build_med_index(meds: dict):
@@ -75,147 +107,798 @@ def build_med_index(meds: dict):
         e["norms"] = list(dict.fromkeys(e["norms"]))
     return index
 
-med_index = build_med_index(medications_data)
-logger.info(f"Med index built with {len(med_index)} entries.")
+def build_med_automaton(index: list):
+    # أول دواء في القائمة يحتفظ بالاسم عند التكرار
+    return build_automaton((n, (entry["key"], entry["raw"])) for entry in index for n in entry["norms"])
+
+def build_med_lookup(meds: dict) -> dict:
+    index = build_med_index(meds)
+    # جداول ثابتة للمطابقة التقريبية تُحسب مرة واحدة بدل إعادة بنائها في كل طلب
+    norm_to_entry = {}
+    for e in index:
+        for n in e["norms"]:
+            norm_to_entry.setdefault(n, e)
+    return {
+        "summary": summarize_medications(meds),
+        "index": index,
+        "automaton": build_med_automaton(index),
+        "all_norms": list(dict.fromkeys(n for e in index for n in e["norms"] if n)),
+        "primary_norms": [e["norms"][0] for e in index if e["norms"]],
+        "norm_to_entry": norm_to_entry,
+    }
+
+# الفهرس يُعاد بناؤه فقط عند تغيّر وقت تعديل medications.json، فيمكن تحديث الأدوية دون إعادة تشغيل الخادم
+@functools.lru_cache(maxsize=1)
+def _meds_cached(mtime_ns):
+    lookup = build_med_lookup(load_medications())
+    logger.info(f"Med index built with {len(lookup['index'])} entries.")
+    return lookup
+
+def get_med_lookup() -> dict:
+    try:
+        mtime_ns = os.stat(MEDS_FILE).st_mtime_ns
+    except OSError:
+        mtime_ns = None
+    return _meds_cached(mtime_ns)
+
+get_med_lookup()
 
 # ---------------- إعداد Faster-Whisper ----------------
-model_name = os.getenv("WHISPER_MODEL", "tiny")
-logger.info(f"Loading faster-whisper model: {model_name}")
-model = WhisperModel(model_name, device="cpu", compute_type="int8")
-logger.info("Faster-whisper model loaded.")
+# WHISPER_MODEL يقبل اسم نموذج أو مسار نموذج CTranslate2 محوّل مسبقاً (انظر convert_model.py)
+# بدونه نستخدم نموذج small المكمّم إن كان قد حُوّل وقت البناء (دقة عربية أفضل)، وإلا tiny
+LOCAL_WHISPER_MODEL = os.path.join("models", "whisper-small-int8_float32")
+model_name = os.getenv("WHISPER_MODEL") or (LOCAL_WHISPER_MODEL if os.path.isdir(LOCAL_WHISPER_MODEL) else "tiny")
+# نستخدم GPU إن وُجدت (فحص CTranslate2 نفسه، دون الحاجة إلى torch)؛ WHISPER_DEVICE=cpu|cuda للتحديد يدوياً
+whisper_device = os.getenv("WHISPER_DEVICE") or ("cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu")
+# على CPU: "auto" يترك CTranslate2 يختار أسرع نوع يدعمه المعالج (مثل int8 مع VNNI)
+# على GPU: int8_float16 أسرع أنماط CTranslate2 ويستهلك نصف ذاكرة float16
+compute_type = os.getenv("WHISPER_COMPUTE") or ("int8_float16" if whisper_device == "cuda" else "auto")
+
+# WHISPER_OV_ENCODER: مسار مُرمِّز OpenVINO INT8 (openvino_encoder_model.xml) مُصدَّر من نفس نموذج WHISPER_MODEL:
+#   optimum-cli export openvino --model openai/whisper-small --weight-format int8 whisper-small-ov-int8
+# المُرمِّز هو الجزء الأثقل على المعالج، ويستفيد OpenVINO من VNNI/AMX أكثر من CTranslate2 على معالجات Intel
+ov_encoder_path = os.getenv("WHISPER_OV_ENCODER")
+
+class OpenVINOEncoderWhisperModel(WhisperModel):
+    # faster-whisper نفسه مع استبدال المُرمِّز فقط؛ فك الترميز يبقى في CTranslate2 الذي يقبل مخرجات مُرمِّز جاهزة
+    def __init__(self, *args, ov_encoder_path: str, **kwargs):
+        super().__init__(*args, **kwargs)
+        import openvino as ov
+
+        core = ov.Core()
+        core.set_property("CPU", {"INFERENCE_NUM_THREADS": cpu_threads, "PERFORMANCE_HINT": "LATENCY"})
+        self.ov_encoder = core.compile_model(ov_encoder_path, "CPU")
+        # IR مُصدَّر من نموذج آخر لا يفشل إلا عند فك الترميز، فنقارنه هنا بمُرمِّز CTranslate2 على نافذة صامتة
+        # ليقع الخطأ في load_whisper_model ويرجع إلى CTranslate2
+        features = np.zeros((1, self.model.n_mels, self.feature_extractor.nb_max_frames), dtype=np.float32)
+        expected = self.model.encode(ctranslate2.StorageView.from_array(features), to_cpu=True).shape
+        actual = self.encode(features).shape
+        if list(actual) != list(expected):
+            raise ValueError(f"OpenVINO encoder output {list(actual)} does not match the Whisper model {list(expected)}")
+
+    def encode(self, features: np.ndarray) -> ctranslate2.StorageView:
+        if features.ndim == 2:
+            features = np.expand_dims(features, 0)
+        # طلب استدلال لكل استدعاء لأن عدة خيوط قد تفرّغ في الوقت نفسه
+        result = self.ov_encoder.create_infer_request().infer({0: features})
+        hidden = np.ascontiguousarray(result[self.ov_encoder.output(0)], dtype=np.float32)
+        return ctranslate2.StorageView.from_array(hidden)
+
+def load_whisper_model() -> WhisperModel:
+    kwargs = dict(device=whisper_device, compute_type=compute_type, cpu_threads=cpu_threads, num_workers=whisper_workers)
+    if whisper_device == "cuda":
+        try:
+            return WhisperModel(model_name, **kwargs)
+        except Exception as e:
+            # مثلاً مكتبات CUDA/cuDNN غير مثبتة في الحاوية
+            logger.error(f"Error loading faster-whisper on CUDA, falling back to CPU: {e}")
+            kwargs.update(device="cpu", compute_type=os.getenv("WHISPER_COMPUTE", "auto"))
+    if ov_encoder_path:
+        try:
+            whisper_model = OpenVINOEncoderWhisperModel(model_name, ov_encoder_path=ov_encoder_path, **kwargs)
+            logger.info(f"Using OpenVINO encoder: {ov_encoder_path}")
+            return whisper_model
+        except Exception as e:
+            logger.error(f"Error loading OpenVINO encoder, falling back to CTranslate2: {e}")
+    return WhisperModel(model_name, **kwargs)
+
+# نسخة واحدة من النموذج لكل عملية؛ تُحمَّل عند الاستيراد داخل العامل نفسه (لا يُستخدم preload_app)
+@functools.lru_cache(maxsize=1)
+def get_whisper() -> WhisperModel:
+    logger.info(f"Loading faster-whisper model: {model_name} (device={whisper_device}, compute_type={compute_type}, cpu_threads={cpu_threads})")
+    whisper_model = load_whisper_model()
+    logger.info(f"Faster-whisper model loaded (device={whisper_model.model.device}, resolved compute_type={whisper_model.model.compute_type}).")
+
+    # تسخين النموذج بثانية صامتة حتى لا يتحمل أول مستخدم كلفة التهيئة
+    # (بدون vad_filter، وإلا يحذف VAD الصمت كله ولا يعمل المُرمِّز)
+    if os.getenv("WHISPER_WARMUP", "1") == "1":
+        warmup_segments, _ = whisper_model.transcribe(np.zeros(16000, dtype=np.float32), language="ar", beam_size=1, without_timestamps=True)
+        list(warmup_segments)
+        logger.info("Faster-whisper warmup done.")
+    return whisper_model
+
+get_whisper()
+
+# مجمّع خيوط محدود للتفريغ: لا يعمل أكثر من whisper_workers تفريغاً في الوقت نفسه مهما زاد عدد الطلبات،
+# فتبقى الذاكرة محدودة ويستفيد CTranslate2 من num_workers لتشغيلها بالتوازي
+whisper_pool = ThreadPoolExecutor(max_workers=whisper_workers, thread_name_prefix="whisper")
+
+WHISPER_VAD_PARAMETERS = dict(min_silence_duration_ms=500)
+
+def transcribe_segments(audio):
+    # audio: ملف في الذاكرة (BytesIO) يفكّه faster-whisper عبر PyAV دون الكتابة على القرص
+    # beam_size=1 (بحث جشع) و vad_filter لتخطي مقاطع الصمت؛ لا نحتاج التوقيتات لأننا نجمع النص فقط
+    segments, info = get_whisper().transcribe(
+        audio,
+        language="ar",
+        beam_size=1,
+        vad_filter=True,
+        vad_parameters=WHISPER_VAD_PARAMETERS,
+        condition_on_previous_text=False,
+        without_timestamps=True,
+    )
+    # segments مولّد كسول: فك الترميز يتقدم فقط بقدر ما نستهلك منه
+    for seg in segments:
+        yield seg.text
 
 # ---------------- إعداد Gemini ----------------
 api_key = os.getenv("GEMINI_API_KEY")
 if not api_key:
     logger.warning("GEMINI_API_KEY not found in environment. Set it on Render Secrets.")
 else:
-    genai.configure(api_key=api_key)
+    # GEMINI_TRANSPORT: "grpc" (افتراضي، قناة HTTP/2 واحدة تتعدد عليها الطلبات) أو "rest" (جلسة requests مع keep-alive)
+    # في الحالتين يُنشأ العميل مرة واحدة عند أول طلب ثم يُعاد استخدامه، فلا ندفع كلفة TCP + TLS لكل سؤال.
+    # لا نفتح الاتصال هنا عمداً: قناة gRPC تُنشأ عند أول طلب في العملية التي تستخدمها
+    genai.configure(api_key=api_key, transport=os.getenv("GEMINI_TRANSPORT", "grpc"))
     gemini_model = genai.GenerativeModel("gemini-1.5-flash")
 
+# مهلة قصوى (بالثواني) لطلب Gemini حتى لا يبقى العامل محجوزاً إذا تأخر الرد
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "10"))
+
+# ---------------- إعداد تحويل النص إلى صوت ----------------
+# PIPER_VOICE: مسار صوت Piper عربي محلي (مثل ar_JO-kareem-low.onnx، يتطلب pip install piper-tts)
+# بدونه نستخدم gTTS الذي يحتاج اتصالاً بخوادم Google في كل رد
+piper_voice_path = os.getenv("PIPER_VOICE")
+# خيوط ONNX لـ TTS: الأنوية الفعلية مقسومة على عمّال gunicorn، دون خيوط Hyper-Threading الإضافية
+tts_threads = int(os.getenv("TTS_THREADS", str(max(1, physical_cores // web_workers))))
+piper_voice = None
+
+def load_piper_voice(model_path: str):
+    # نبني جلسة onnxruntime بأنفسنا (بدل PiperVoice.load) لنتحكم في الخيوط ومستوى تحسين الرسم
+    import onnxruntime
+    from piper import PiperVoice
+    from piper.config import PiperConfig
+
+    with open(f"{model_path}.json", "r", encoding="utf-8") as f:
+        config = PiperConfig.from_dict(json.load(f))
+    so = onnxruntime.SessionOptions()
+    so.intra_op_num_threads = tts_threads
+    so.inter_op_num_threads = 1
+    so.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session = onnxruntime.InferenceSession(model_path, sess_options=so, providers=["CPUExecutionProvider"])
+    return PiperVoice(session=session, config=config)
+
+if piper_voice_path:
+    try:
+        piper_voice = load_piper_voice(piper_voice_path)
+        logger.info(f"Loaded Piper voice: {piper_voice_path} (threads={tts_threads})")
+        # جملة قصيرة في الذاكرة لتهيئة جلسة ONNX و espeak قبل أول رد
+        if os.getenv("TTS_WARMUP", "1") == "1":
+            with wave.open(io.BytesIO(), "wb") as wav_file:
+                piper_voice.synthesize_wav("مرحبا", wav_file)
+            logger.info("Piper warmup done.")
+    except Exception as e:
+        logger.error(f"Error loading Piper voice, falling back to gTTS: {e}")
+
+AUDIO_EXT = "wav" if piper_voice else "mp3"
+# نوع MIME ثابت بدل mimetypes.guess_type الذي يعتمد على /etc/mime.types (audio/x-wav على بعض الأنظمة)
+AUDIO_MIMETYPES = {"wav": "audio/wav", "mp3": "audio/mpeg"}
+
+def synthesize_speech(text: str, audio_path: str):
+    if piper_voice:
+        with wave.open(audio_path, "wb") as wav_file:
+            piper_voice.synthesize_wav(text, wav_file)
+    else:
+        tts = gTTS(text=text, lang="ar", slow=False)
+        tts.save(audio_path)
+
+# الملفات الصوتية تُسمّى ببصمة sha1 للنص، فالرد المتكرر (مثل معلومات الدواء نفسه) لا يُعاد توليده
+TTS_CACHE_MAX_FILES = int(os.getenv("TTS_CACHE_MAX_FILES", "500"))
+
+def evict_tts_cache():
+    entries = []
+    with os.scandir(AUDIO_RESPONSES_FOLDER) as it:
+        for entry in it:
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                entries.append((entry.stat().st_mtime, entry.path))
+    if len(entries) <= TTS_CACHE_MAX_FILES:
+        return
+    entries.sort()
+    for _, path in entries[:len(entries) - TTS_CACHE_MAX_FILES]:
+        try:
+            os.remove(path)
+            logger.info(f"Evicted cached TTS file {path}")
+        except OSError:
+            pass
+
+# تنظيف دوري: يحذف كل ملف لم يُستخدم منذ RESPONSES_TTL_SECONDS (وقت التعديل يُحدَّث عند كل استخدام)،
+# ومنها الملفات المؤقتة اليتيمة إن توقفت عملية أثناء الكتابة
+RESPONSES_TTL_SECONDS = int(os.getenv("RESPONSES_TTL_SECONDS", "600"))
+RESPONSES_SWEEP_INTERVAL = 60
+
+def sweep_responses_folder():
+    cutoff = time.time() - RESPONSES_TTL_SECONDS
+    with os.scandir(AUDIO_RESPONSES_FOLDER) as it:
+        for entry in it:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    logger.info(f"Removed expired TTS file {entry.path}")
+            except OSError:
+                pass
+
+def _sweep_loop():
+    while True:
+        time.sleep(RESPONSES_SWEEP_INTERVAL)
+        try:
+            sweep_responses_folder()
+        except Exception:
+            logger.exception("Error cleaning responses folder")
+
+if RESPONSES_TTL_SECONDS > 0:
+    threading.Thread(target=_sweep_loop, name="responses-sweeper", daemon=True).start()
+
+def tts_cache_key(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def touch_cached_audio(audio_path: str) -> bool:
+    try:
+        os.utime(audio_path)  # تحديث وقت الاستخدام لسياسة LRU
+        logger.info(f"TTS cache hit: {audio_path}")
+        return True
+    except FileNotFoundError:
+        return False
+
+def tmp_audio_path(audio_path: str) -> str:
+    # نكتب في ملف مؤقت ثم نستبدله دفعة واحدة حتى لا يُقرأ ملف ناقص عند الطلبات المتزامنة
+    return f"{audio_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+def get_tts_audio(text: str) -> str:
+    audio_filename = f"{tts_cache_key(text)}.{AUDIO_EXT}"
+    audio_path = os.path.join(AUDIO_RESPONSES_FOLDER, audio_filename)
+    if touch_cached_audio(audio_path):
+        return audio_filename
+
+    tmp_path = tmp_audio_path(audio_path)
+    try:
+        synthesize_speech(text, tmp_path)
+        os.replace(tmp_path, audio_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    logger.info(f"TTS saved to {audio_path}")
+    evict_tts_cache()
+    return audio_filename
+
+# ---------------- توليف الجمل بالتوازي ----------------
+# ردود Gemini تُقسم إلى جمل تُوَلَّف في مجمّع خيوط أثناء وصول بقية الرد، ثم تُلصق بالترتيب في ملف الكاش
+TTS_WORKERS = int(os.getenv("TTS_WORKERS", "4"))
+tts_pool = ThreadPoolExecutor(max_workers=TTS_WORKERS, thread_name_prefix="tts")
+
+def synthesize_sentence(text: str) -> bytes:
+    # Piper: عينات PCM خام؛ gTTS: إطارات MP3 يمكن لصقها مباشرة
+    if piper_voice:
+        return b"".join(chunk.audio_int16_bytes for chunk in piper_voice.synthesize(text))
+    buf = io.BytesIO()
+    gTTS(text=text, lang="ar", slow=False).write_to_fp(buf)
+    return buf.getvalue()
+
+def submit_sentences(text: str) -> list:
+    return [tts_pool.submit(synthesize_sentence, sentence.strip()) for sentence in split_sentences(text) if sentence.strip()]
+
+def save_sentence_audio(text: str, audio_parts: list):
+    audio_path = os.path.join(AUDIO_RESPONSES_FOLDER, f"{tts_cache_key(text)}.{AUDIO_EXT}")
+    tmp_path = tmp_audio_path(audio_path)
+    try:
+        if piper_voice:
+            with wave.open(tmp_path, "wb") as wav_file:
+                wav_file.setnchannels(1)
+                wav_file.setsampwidth(2)
+                wav_file.setframerate(piper_voice.config.sample_rate)
+                for part in audio_parts:
+                    wav_file.writeframes(part.result())
+        else:
+            with open(tmp_path, "wb") as f:
+                for part in audio_parts:
+                    f.write(part.result())
+        os.replace(tmp_path, audio_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    logger.info(f"TTS saved to {audio_path} ({len(audio_parts)} sentence(s))")
+    evict_tts_cache()
+
+# ---------------- بث الصوت أثناء توليده ----------------
+# مع Piper يعيد /upload رابط /tts_stream/<key> فوراً ويُبث الصوت جملة بجملة بينما يُحفظ في ملف الكاش.
+# سجل البث في ذاكرة العامل، فيُعطَّل مع أكثر من عامل gunicorn لأن طلب الرابط قد يصل إلى عامل آخر
+TTS_STREAMING = os.getenv("TTS_STREAMING", "1") == "1" and web_workers == 1
+if web_workers > 1 and os.getenv("TTS_STREAMING", "1") == "1":
+    logger.info(f"TTS streaming disabled with {web_workers} gunicorn workers; answers are served from /responses")
+TTS_KEY_RE = re.compile(r"[0-9a-f]{40}")
+# توليف واحد لكل مفتاح: الطلبات المتزامنة للرابط نفسه تقرأ من نفس المقاطع
+tts_streams = {}
+tts_streams_lock = threading.Lock()
+
+def wav_stream_header(sample_rate: int) -> bytes:
+    # رأس RIFF بطول غير معروف (0xFFFFFFFF) لأن عدد العينات لا يُعرف قبل انتهاء التوليف
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 0xFFFFFFFF, b"WAVE",
+        b"fmt ", 16, 1, 1, sample_rate, sample_rate * 2, 2, 16,
+        b"data", 0xFFFFFFFF,
+    )
+
+def get_tts_url(text: str) -> str:
+    if not (piper_voice and TTS_STREAMING):
+        return f"/responses/{get_tts_audio(text)}"
+
+    key = tts_cache_key(text)
+    audio_filename = f"{key}.{AUDIO_EXT}"
+    if touch_cached_audio(os.path.join(AUDIO_RESPONSES_FOLDER, audio_filename)):
+        return f"/responses/{audio_filename}"
+    start_tts_stream(key, text)
+    return f"/tts_stream/{key}"
+
+def start_tts_stream(key: str, text: str, audio_parts: list = None):
+    # audio_parts: مستقبلات جمل أُرسلت مسبقاً إلى tts_pool (رد Gemini)، وإلا تُقسم text هنا
+    with tts_streams_lock:
+        if key in tts_streams:
+            return
+        stream = {"chunks": [], "done": False, "cond": threading.Condition()}
+        tts_streams[key] = stream
+    if audio_parts is None:
+        audio_parts = submit_sentences(text)
+    # التوليف نفسه في tts_pool؛ هذا الخيط ينتظر الجمل بالترتيب ويكتبها فقط
+    # (لا يعمل داخل tts_pool حتى لا ينتظر عامل في المجمّع مهاماً خلفه في الطابور نفسه)
+    threading.Thread(target=render_tts_stream, args=(key, audio_parts, stream), name="tts-stream", daemon=True).start()
+
+def render_tts_stream(key: str, audio_parts: list, stream: dict):
+    audio_path = os.path.join(AUDIO_RESPONSES_FOLDER, f"{key}.{AUDIO_EXT}")
+    tmp_path = tmp_audio_path(audio_path)
+    try:
+        with wave.open(tmp_path, "wb") as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(piper_voice.config.sample_rate)
+            for part in audio_parts:
+                pcm = part.result()
+                wav_file.writeframes(pcm)
+                with stream["cond"]:
+                    stream["chunks"].append(pcm)
+                    stream["cond"].notify_all()
+        os.replace(tmp_path, audio_path)
+        logger.info(f"TTS streamed and saved to {audio_path}")
+        evict_tts_cache()
+    except Exception:
+        logger.exception("Error streaming TTS")
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        with stream["cond"]:
+            stream["done"] = True
+            stream["cond"].notify_all()
+        # بعد os.replace: من لا يجد المفتاح هنا يجد الملف
+        with tts_streams_lock:
+            tts_streams.pop(key, None)
+
+def read_tts_stream(stream: dict):
+    # يرسل المقاطع الجاهزة ثم ينتظر التالية؛ إغلاق العميل للاتصال لا يوقف التوليف ولا الحفظ
+    yield wav_stream_header(piper_voice.config.sample_rate)
+    sent = 0
+    while True:
+        with stream["cond"]:
+            stream["cond"].wait_for(lambda: len(stream["chunks"]) > sent or stream["done"])
+            chunks = stream["chunks"][sent:]
+            done = stream["done"]
+        sent += len(chunks)
+        if chunks:
+            yield b"".join(chunks)
+        if done:
+            return
+
 # ---------------- دالة للبحث عن دواء ----------------
+def find_med_exact(norm_text: str):
+    # exact substring match (Aho-Corasick: one pass over the text)
+    match = first_match(get_med_lookup()["automaton"], norm_text)
+    if match:
+        key, raw = match
+        logger.info(f"Exact match found: '{key}'")
+        return key, raw
+    return None, None
+
 def find_med_in_text(text: str):
     norm_text = normalize_arabic(text)
     logger.info(f"Normalized question: '{norm_text}'")
 
     # 1) exact substring match
-    for entry in med_index:
-        for n in entry["norms"]:
-            if n and n in norm_text:
-                logger.info(f"Exact match found: '{entry['key']}' via norm '{n}'")
-                return entry["key"], entry["raw"]
+    med_key, med_info = find_med_exact(norm_text)
+    if med_key:
+        return med_key, med_info
+
+    lookup = get_med_lookup()
+    all_norms = lookup["all_norms"]
+    norm_to_entry = lookup["norm_to_entry"]
 
     # 2) token-based fuzzy matching
+    # مصفوفة درجات (الكلمات × الأسماء) تُحسب دفعة واحدة؛ الدرجات تحت الحد تصبح 0
     tokens = norm_text.split()
-    med_names_norm = []
-    for entry in med_index:
-        med_names_norm.extend(entry["norms"])
-    med_names_norm = list(dict.fromkeys(med_names_norm))
-
-    for token in tokens:
-        matches = difflib.get_close_matches(token, med_names_norm, n=1, cutoff=0.75)
-        if matches:
-            matched_norm = matches[0]
-            for entry in med_index:
-                if matched_norm in entry["norms"]:
-                    logger.info(f"Fuzzy token match: token '{token}' -> '{entry['key']}' (norm '{matched_norm}')")
-                    return entry["key"], entry["raw"]
+    if tokens and all_norms:
+        scores = process.cdist(tokens, all_norms, scorer=fuzz.ratio, score_cutoff=75, dtype=np.uint8)
+        i, j = np.unravel_index(scores.argmax(), scores.shape)
+        if scores[i, j] >= 75:
+            matched_norm = all_norms[j]
+            entry = norm_to_entry[matched_norm]
+            logger.info(f"Fuzzy token match: token '{tokens[i]}' -> '{entry['key']}' (norm '{matched_norm}')")
+            return entry["key"], entry["raw"]
 
     # 3) overall fuzzy match
-    med_name_list = [e["norms"][0] for e in med_index if e["norms"]]
-    overall_matches = difflib.get_close_matches(norm_text, med_name_list, n=1, cutoff=0.6)
-    if overall_matches:
-        matched_norm = overall_matches[0]
-        for entry in med_index:
-            if matched_norm == entry["norms"][0]:
-                logger.info(f"Overall fuzzy match: '{entry['key']}'")
-                return entry["key"], entry["raw"]
+    overall_match = process.extractOne(norm_text, lookup["primary_norms"], scorer=fuzz.token_set_ratio, score_cutoff=60)
+    if overall_match:
+        entry = norm_to_entry[overall_match[0]]
+        logger.info(f"Overall fuzzy match: '{entry['key']}'")
+        return entry["key"], entry["raw"]
 
     return None, None
 
-# ---------------- المسارات ----------------
-@app.route("/")
-def index():
-    return render_template("index.html")
+def transcribe_until_med(audio):
+    # نبحث عن اسم الدواء بعد كل مقطع؛ إذا ظهر اسم مطابق تماماً نوقف Whisper دون فك بقية الصوت
+    # (المطابقة التقريبية على نص جزئي غير موثوقة، فتبقى لما بعد اكتمال النص)
+    parts = []
+    for text in transcribe_segments(audio):
+        parts.append(text)
+        med_key, med_info = find_med_exact(normalize_arabic(" ".join(parts)))
+        if med_key:
+            logger.info(f"Med found after {len(parts)} segment(s); skipping the rest of the audio")
+            return " ".join(parts).strip(), med_key, med_info
+    return " ".join(parts).strip(), None, None
 
-@app.route("/upload", methods=["POST"])
-def upload_audio():
-    if "file" not in request.files:
-        return jsonify({"error": "لم يتم رفع أي ملف بصمة 'file'"}), 400
-    file = request.files["file"]
-    if file.filename == "":
-        return jsonify({"error": "اسم الملف فارغ"}), 400
+# ---------------- تجميع طلبات التفريغ (micro-batching) ----------------
+# WHISPER_BATCH=1: استدعاءات المُرمِّز المتزامنة من whisper_pool تُجمع في استدعاء encode واحد، وباقي transcribe كما هو
+WHISPER_BATCH = os.getenv("WHISPER_BATCH", "0") == "1"
+# لا يستدعي المُرمِّز إلا خيوط whisper_pool، فلا تكبر الدفعة عن عددها
+BATCH_MAX = int(os.getenv("WHISPER_BATCH_MAX", str(whisper_workers)))
+BATCH_WINDOW_MS = int(os.getenv("WHISPER_BATCH_WINDOW_MS", "20"))
+# عناصر الطابور: (features, done_event, result_slot)
+batch_queue = queue.Queue()
+
+def batched_encode(features: np.ndarray) -> ctranslate2.StorageView:
+    # بديل WhisperModel.encode: يضع مقطع mel في الطابور وينتظر مخرجات المُرمِّز الخاصة به
+    done = threading.Event()
+    slot = {}
+    batch_queue.put((features, done, slot))
+    done.wait()
+    if "error" in slot:
+        raise slot["error"]
+    return slot["output"]
+
+def _batch_loop(encode):
+    # encode: دالة المُرمِّز الأصلية للنموذج (CTranslate2 أو OpenVINO)
+    while True:
+        batch = [batch_queue.get()]
+        deadline = time.monotonic() + BATCH_WINDOW_MS / 1000
+        while len(batch) < BATCH_MAX:
+            try:
+                batch.append(batch_queue.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        try:
+            # كل عنصر (n_mels, frames) أو (n, n_mels, frames) كما يقبله encode الأصلي
+            items = [features.reshape((-1,) + features.shape[-2:]) for features, _, _ in batch]
+            output = encode(np.concatenate(items))
+            # ننقل المخرجات إلى المعالج لنقسمها بـ numpy؛ generate ينقلها إلى جهاز النموذج من جديد
+            if output.device != "cpu":
+                output = output.to_device(ctranslate2.Device.cpu)
+            output = np.asarray(output)
+            start = 0
+            for item, (_, _, slot) in zip(items, batch):
+                slot["output"] = ctranslate2.StorageView.from_array(np.ascontiguousarray(output[start:start + len(item)]))
+                start += len(item)
+            logger.info(f"Encoded a batch of {len(batch)} segment(s)")
+        except Exception as e:
+            logger.exception("Batched encoder error")
+            for _, _, slot in batch:
+                slot["error"] = e
+        finally:
+            for _, done, _ in batch:
+                done.set()
+
+if WHISPER_BATCH:
+    # خيط واحد لكل عملية يملك استدعاءات المُرمِّز؛ transcribe يستدعي self.encode فيمر بالبديل
+    threading.Thread(target=_batch_loop, args=(get_whisper().encode,), name="whisper-batch", daemon=True).start()
+    get_whisper().encode = batched_encode
+
+# ---------------- معالجة الصوت ----------------
+def answer_question(question_text: str, med_key, med_info) -> str:
+    if med_key:
+        if isinstance(med_info, dict):
+            dose = med_info.get("الجرعة") or med_info.get("dose") or "غير محددة"
+            time_ = med_info.get("الوقت") or med_info.get("time") or "غير محدد"
+            notes = med_info.get("ملاحظات") or med_info.get("notes") or ""
+            answer_text = f"{med_key}: الجرعة {dose}. الوقت: {time_}. {notes}"
+        else:
+            answer_text = f"{med_key}: {med_info}"
+        logger.info(f"Answer from meds file: {answer_text}")
+        return answer_text
+
+    if not api_key:
+        return "خدمة Gemini غير مهيّأة حالياً (GEMINI_API_KEY مفقود)."
+
+    meds_summary = get_med_lookup()["summary"]
+    cache_key = (normalize_arabic(question_text), meds_summary)
+    with gemini_cache_lock:
+        answer_text = gemini_cache.get(cache_key)
+        if answer_text is not None:
+            gemini_cache.move_to_end(cache_key)
+    if answer_text is not None:
+        logger.info("Answer from Gemini cache.")
+        return answer_text
 
-    filepath = None
     try:
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
-        file.save(filepath)
-        logger.info(f"Saved upload: {filepath}")
+        answer_text = ask_gemini(question_text, meds_summary)
+        logger.info("Answer from Gemini obtained.")
+        with gemini_cache_lock:
+            gemini_cache[cache_key] = answer_text
+            while len(gemini_cache) > GEMINI_CACHE_SIZE:
+                gemini_cache.popitem(last=False)
+    except google_exceptions.DeadlineExceeded:
+        logger.error(f"Gemini did not answer within {GEMINI_TIMEOUT}s")
+        answer_text = "تأخر رد خدمة Gemini، حاول مرة أخرى."
+    except ValueError:
+        answer_text = "⚠️ لم يتم الحصول على رد من Gemini"
+    except Exception as e:
+        logger.error(f"Error calling Gemini: {e}")
+        answer_text = "حدث خطأ عند الاتصال بخدمة Gemini."
+    return answer_text
+
+# كاش الردود النصية (LRU): السؤال المطبَّع هو المفتاح فقط، فالسؤال نفسه بتشكيل أو همزات مختلفة لا يعيد طلب Gemini،
+# بينما يصل إلى Gemini نص المريض الأصلي كما فرّغه Whisper؛ ملخص الأدوية جزء من المفتاح حتى تُهمل الردود
+# القديمة عند تعديل medications.json. الأخطاء والردود الفارغة لا تُخزَّن، فيُعاد طلبها في المرة التالية
+GEMINI_CACHE_SIZE = int(os.getenv("GEMINI_CACHE_SIZE", "2048"))
+gemini_cache = OrderedDict()
+gemini_cache_lock = threading.Lock()
+
+def ask_gemini(question_text: str, meds_summary: str) -> str:
+    prompt = (
+        "أنت مساعد طبي محدد بمعلومات الدواء الموجودة في القائمة التالية. "
+        "إذا سأل المستخدم عن أحد الأدوية في هذه القائمة، جاوب حسب هذه المعلومات فقط. "
+        "أجب بالعربية وباختصار.\n\n"
+        f"قائمة الأدوية: {meds_summary}\n\n"
+        f"سؤال المريض: {question_text}"
+    )
+    # نستقبل الرد كتدفق، وكل جملة تكتمل تُرسل فوراً إلى TTS بينما يواصل Gemini التوليد
+    stream = gemini_model.generate_content(prompt, stream=True, request_options={"timeout": GEMINI_TIMEOUT})
+    sentences = []
+    audio_parts = []
+    try:
+        # .text يرفع ValueError لدفعة بلا parts (دفعة STOP/MAX_TOKENS الأخيرة أو قطع SAFETY/RECITATION)
+        for sentence in iter_sentences(chunk.text if chunk.parts else "" for chunk in stream):
+            sentences.append(sentence)
+            if sentence.strip():
+                audio_parts.append(tts_pool.submit(synthesize_sentence, sentence.strip()))
+    except Exception:
+        # الرد يُستبدل برسالة الخطأ، فلا فائدة من توليف جمله
+        for part in audio_parts:
+            part.cancel()
+        raise
 
+    answer_text = "".join(sentences).strip()
+    if not answer_text:
+        raise ValueError("empty Gemini response")
+    if piper_voice and TTS_STREAMING:
+        # لا ننتظر الجمل: /tts_stream يبث كل جملة فور انتهاء توليفها
+        start_tts_stream(tts_cache_key(answer_text), answer_text, audio_parts)
+        return answer_text
+    try:
+        # gTTS (أو بدون بث): الملف المحفوظ يحتاج كل الجمل، فينتظر /upload آخر جملة
+        save_sentence_audio(answer_text, audio_parts)
+    except Exception as e:
+        # الرد النصي سليم؛ get_tts_url سيولّد الصوت كاملاً كالمعتاد
+        logger.error(f"Error synthesizing Gemini sentences: {e}")
+    return answer_text
+
+def process_audio(audio_bytes: bytes):
+    # يعيد (جسم الرد JSON، رمز الحالة) ليُستخدم من المسار المتزامن ومن المهام الخلفية
+    try:
         # transcribe
-        segments, info = model.transcribe(filepath, language="ar")
-        question_text = " ".join([seg.text for seg in segments]).strip()
+        question_text, med_key, med_info = whisper_pool.submit(transcribe_until_med, io.BytesIO(audio_bytes)).result()
         logger.info(f"Transcribed text: '{question_text}'")
 
         if not question_text:
-            return jsonify({"error": "النص المستخرج فارغ"}), 400
+            return {"error": "النص المستخرج فارغ"}, 400
 
         # search meds
-        med_key, med_info = find_med_in_text(question_text)
-        answer_text = ""
-
-        if med_key:
-            if isinstance(med_info, dict):
-                dose = med_info.get("الجرعة") or med_info.get("dose") or "غير محددة"
-                time_ = med_info.get("الوقت") or med_info.get("time") or "غير محدد"
-                notes = med_info.get("ملاحظات") or med_info.get("notes") or ""
-                answer_text = f"{med_key}: الجرعة {dose}. الوقت: {time_}. {notes}"
-            else:
-                answer_text = f"{med_key}: {med_info}"
-            logger.info(f"Answer from meds file: {answer_text}")
-        else:
-            if api_key:
-                prompt = (
-                    "أنت مساعد طبي محدد بمعلومات الدواء الموجودة في القائمة التالية. "
-                    "إذا سأل المستخدم عن أحد الأدوية في هذه القائمة، جاوب حسب هذه المعلومات فقط. "
-                    "أجب بالعربية وباختصار.\n\n"
-                    f"قائمة الأدوية: {json.dumps(medications_data, ensure_ascii=False)}\n\n"
-                    f"سؤال المريض: {question_text}"
-                )
-                try:
-                    gemini_response = gemini_model.generate_content(prompt)
-                    answer_text = gemini_response.text.strip() if gemini_response.text else "⚠️ لم يتم الحصول على رد من Gemini"
-                    logger.info("Answer from Gemini obtained.")
-                except Exception as e:
-                    logger.error(f"Error calling Gemini: {e}")
-                    answer_text = "حدث خطأ عند الاتصال بخدمة Gemini."
-            else:
-                answer_text = "خدمة Gemini غير مهيّأة حالياً (GEMINI_API_KEY مفقود)."
+        if not med_key:
+            med_key, med_info = find_med_in_text(question_text)
+        answer_text = answer_question(question_text, med_key, med_info)
 
         # TTS
-        audio_filename = f"response_{int(time.time())}.mp3"
-        audio_path = os.path.join(AUDIO_RESPONSES_FOLDER, audio_filename)
-        tts = gTTS(text=answer_text, lang="ar", slow=False)
-        tts.save(audio_path)
-        logger.info(f"TTS saved to {audio_path}")
+        audio_url = get_tts_url(answer_text)
 
-        return jsonify({
+        return {
             "question": question_text,
             "answer": answer_text,
-            "audio_url": f"/responses/{audio_filename}"
-        })
+            "audio_url": audio_url
+        }, 200
 
-    except Exception as e:
+    except Exception:
         logger.exception("Processing error")
-        return jsonify({"error": "حدث خطأ داخلي في الخادم"}), 500
+        return {"error": "حدث خطأ داخلي في الخادم"}, 500
+
+# ---------------- المهام الخلفية ----------------
+# /upload_async يعيد معرّف مهمة فوراً ويعالج الصوت في خيط خلفي، والعميل يسأل /result/<job_id>.
+# حالة المهمة ملف JSON في JOBS_FOLDER، فيجيب عنها أي عامل gunicorn وليس العامل الذي نفّذها فقط
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", "2"))
+JOBS_FOLDER = "jobs"
+os.makedirs(JOBS_FOLDER, exist_ok=True)
+JOB_ID_RE = re.compile(r"[0-9a-f]{32}")
+MAX_JOBS = int(os.getenv("MAX_JOBS", "200"))
+# حد للمهام التي لم تنتهِ بعد في كل العمّال معاً، يُقسم بينها لأن كل عامل يعدّ مهامه فقط
+MAX_PENDING_JOBS = int(os.getenv("MAX_PENDING_JOBS", str(PIPELINE_WORKERS * 8 * web_workers)))
+max_pending_jobs = max(1, MAX_PENDING_JOBS // web_workers)
+pipeline_executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix="pipeline")
+jobs_lock = threading.Lock()
+pending_jobs = 0
+
+def job_path(job_id: str) -> str:
+    return os.path.join(JOBS_FOLDER, f"{job_id}.json")
+
+def write_job(job_id: str, job: dict):
+    # كتابة ذرية عبر ملف مؤقت حتى لا يقرأ /result ملفاً ناقصاً
+    path = job_path(job_id)
+    tmp_path = tmp_audio_path(path)
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(job, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def evict_job_results():
+    # نحذف أقدم ملفات المهام حتى لا يكبر المجلد بلا حد
+    entries = []
+    with os.scandir(JOBS_FOLDER) as it:
+        for entry in it:
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                entries.append((entry.stat().st_mtime, entry.path))
+    entries.sort()
+    for _, path in entries[:max(0, len(entries) - MAX_JOBS)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def run_job(job_id: str, audio_bytes: bytes):
+    global pending_jobs
+    try:
+        result, status = process_audio(audio_bytes)
+        write_job(job_id, {"done": True, "status": status, "result": result})
+        evict_job_results()
+    except Exception:
+        logger.exception(f"Error saving result of job {job_id}")
     finally:
-        if filepath and os.path.exists(filepath):
-            os.remove(filepath)
-            logger.info(f"Removed temp file {filepath}")
+        with jobs_lock:
+            pending_jobs -= 1
+
+def submit_job(audio_bytes: bytes):
+    # يعيد معرّف المهمة، أو None إذا امتلأ الطابور
+    global pending_jobs
+    with jobs_lock:
+        if pending_jobs >= max_pending_jobs:
+            return None
+        pending_jobs += 1
+    job_id = uuid.uuid4().hex
+    try:
+        write_job(job_id, {"done": False})
+        pipeline_executor.submit(run_job, job_id, audio_bytes)
+    except Exception:
+        with jobs_lock:
+            pending_jobs -= 1
+        raise
+    return job_id
+
+# ---------------- المسارات ----------------
+@app.route("/")
+def index():
+    return render_template("index.html")
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({"error": f"الملف المرفوع أكبر من الحد المسموح ({MAX_UPLOAD_BYTES // (1024 * 1024)} ميغابايت)"}), 413
+
+def read_upload():
+    if "file" not in request.files:
+        return None, (jsonify({"error": "لم يتم رفع أي ملف بصمة 'file'"}), 400)
+    file = request.files["file"]
+    if file.filename == "":
+        return None, (jsonify({"error": "اسم الملف فارغ"}), 400)
+
+    # الحد يفرضه MAX_CONTENT_LENGTH: عند الوصول إلى request.files يكون Werkzeug قد حلّل جسم multipart
+    # وخزّن الملف (في ملف مؤقت إن كان كبيراً)، ويرفض الطلب بـ 413 إن تجاوز الحد حتى بدون Content-Length
+    audio_bytes = file.read()
+    if not audio_bytes:
+        return None, (jsonify({"error": "الملف المرفوع فارغ"}), 400)
+    logger.info(f"Received upload: {file.filename} ({len(audio_bytes)} bytes)")
+    return audio_bytes, None
+
+@app.route("/upload", methods=["POST"])
+def upload_audio():
+    audio_bytes, error = read_upload()
+    if error:
+        return error
+    result, status = process_audio(audio_bytes)
+    return jsonify(result), status
+
+@app.route("/upload_async", methods=["POST"])
+def upload_audio_async():
+    audio_bytes, error = read_upload()
+    if error:
+        return error
+    job_id = submit_job(audio_bytes)
+    if job_id is None:
+        logger.warning(f"Rejecting async upload: {max_pending_jobs} jobs already pending in this worker")
+        return jsonify({"error": "الخادم مشغول حالياً، حاول مرة أخرى بعد قليل"}), 503, {"Retry-After": "5"}
+    return jsonify({"job_id": job_id, "result_url": f"/result/{job_id}"}), 202
+
+@app.route("/result/<job_id>")
+def get_job_result(job_id):
+    if not JOB_ID_RE.fullmatch(job_id):
+        return jsonify({"error": "المهمة غير موجودة"}), 404
+    try:
+        with open(job_path(job_id), encoding="utf-8") as f:
+            job = json.load(f)
+    except FileNotFoundError:
+        return jsonify({"error": "المهمة غير موجودة"}), 404
+    if not job["done"]:
+        return jsonify({"status": "pending"}), 202
+    return jsonify(job["result"]), job["status"]
+
+@app.route("/tts_stream/<key>")
+def stream_tts_audio(key):
+    if not TTS_KEY_RE.fullmatch(key):
+        abort(404)
+    with tts_streams_lock:
+        stream = tts_streams.get(key)
+    # البث بلا طول معروف يصلح فقط لطلب الملف من أوله؛ Safari/iOS يبدأ بـ Range: bytes=0-1 ويحتاج 206،
+    # فننتظر اكتمال الملف ثم نقدّمه بدعم Range
+    if stream and request.range and request.range.ranges != [(0, None)]:
+        with stream["cond"]:
+            stream["cond"].wait_for(lambda: stream["done"], timeout=120)
+        stream = None
+    if stream:
+        return Response(stream_with_context(read_tts_stream(stream)), mimetype=AUDIO_MIMETYPES["wav"])
+    audio_filename = f"{key}.{AUDIO_EXT}"
+    if os.path.isfile(os.path.join(AUDIO_RESPONSES_FOLDER, audio_filename)):
+        return get_response_audio(audio_filename)
+    return jsonify({"error": "الملف الصوتي غير موجود"}), 404
+
+# أسماء الملفات الصوتية بصمة لمحتواها (sha1 للنص)، فلا يتغير محتوى الرابط أبداً ويمكن تخزينه في المتصفح
+AUDIO_MAX_AGE = 31536000
 
 @app.route("/responses/<path:filename>")
 def get_response_audio(filename):
-    return send_from_directory(AUDIO_RESPONSES_FOLDER, filename)
+    mimetype = AUDIO_MIMETYPES.get(filename.rsplit(".", 1)[-1], "application/octet-stream")
+    if RESPONSES_ACCEL_PREFIX:
+        path = safe_join(AUDIO_RESPONSES_FOLDER, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        response = app.response_class(mimetype=mimetype)
+        response.headers["X-Accel-Redirect"] = f"{RESPONSES_ACCEL_PREFIX}/{filename}"
+    else:
+        # send_file يمرّر الملف إلى wsgi.file_wrapper، و gunicorn (gthread) يرسله عبر sendfile(2) دون نسخه داخل Python؛
+        # conditional يدعم Range و If-None-Match (304) لإعادة التشغيل والتقديم الجزئي في المتصفح
+        response = send_from_directory(
+            AUDIO_RESPONSES_FOLDER, filename, mimetype=mimetype, conditional=True, etag=True, max_age=AUDIO_MAX_AGE
+        )
+    response.headers["Cache-Control"] = f"public, immutable, max-age={AUDIO_MAX_AGE}"
+    return response
 
+# للتطوير المحلي فقط؛ في الإنتاج يعمل التطبيق تحت gunicorn (انظر Procfile و gunicorn.conf.py)
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    app.run(host="0.0.0.0", port=5000, debug=os.getenv("FLASK_DEBUG") == "1")
@@ -1,11 +1,14 @@
 import os
-import whisper
+from collections import deque
+import numpy as np
+from faster_whisper import WhisperModel
 import sounddevice as sd
-import wavio
+import webrtcvad
 from gtts import gTTS
+from text_utils import normalize_arabic, build_automaton, first_match
 
-# تحميل نموذج Whisper الخفيف
-model = whisper.load_model("base")
+# تحميل نموذج Whisper الخفيف (faster-whisper: نفس الأوزان مع CTranslate2 و int8 على المعالج)
+model = WhisperModel("base", device="cpu", compute_type="int8")
 
 # قاعدة بيانات الأسئلة والأجوبة
 qa_data = {
@@ -16,27 +19,78 @@ qa_data = {
 }
 
 # تسجيل الصوت
-def record_audio(filename, duration=5, fs=16000):
+# الميكروفون يُفتح مرة واحدة عند التشغيل بدل فتح الجهاز في كل تسجيل (sd.rec)،
+# ونقرأ منه إطارات 20ms يفحصها webrtcvad: يبدأ التسجيل مع أول كلام وينتهي بعد صمت قصير
+SAMPLE_RATE = 16000
+FRAME_MS = 20
+FRAME_SAMPLES = SAMPLE_RATE * FRAME_MS // 1000
+vad = webrtcvad.Vad(2)
+mic = sd.InputStream(samplerate=SAMPLE_RATE, channels=1, dtype="int16", blocksize=FRAME_SAMPLES)
+mic.start()
+
+def record_audio(max_duration=15, silence_ms=800, preroll_ms=300):
     print("🎙️ ابدأ الكلام الآن...")
-    recording = sd.rec(int(duration * fs), samplerate=fs, channels=1, dtype="int16")
-    sd.wait()
-    wavio.write(filename, recording, fs, sampwidth=2)
+    # نتجاهل ما تراكم في المخزن أثناء الرد السابق (صوت السماعة نفسه)
+    if mic.read_available:
+        mic.read(mic.read_available)
+
+    # نحتفظ بآخر preroll_ms قبل بداية الكلام حتى لا يضيع أول المقطع
+    preroll = deque(maxlen=preroll_ms // FRAME_MS)
+    frames = []
+    silent_frames = 0
+    while len(frames) < max_duration * 1000 // FRAME_MS:
+        frame, _ = mic.read(FRAME_SAMPLES)
+        is_speech = vad.is_speech(frame.tobytes(), SAMPLE_RATE)
+        if not frames:
+            preroll.append(frame)
+            if is_speech:
+                frames.extend(preroll)
+            continue
+        frames.append(frame)
+        silent_frames = 0 if is_speech else silent_frames + 1
+        if silent_frames >= silence_ms // FRAME_MS:
+            break
     print("✅ انتهى التسجيل")
+    # float32 أحادي بتردد 16kHz، الصيغة التي يقبلها Whisper مباشرة بدون ملف WAV
+    return np.concatenate(frames)[:, 0].astype(np.float32) / 32768.0
 
 # تحويل الصوت إلى نص
-def speech_to_text(filename):
-    result = model.transcribe(filename, language="ar")
-    return result["text"].strip()
+def speech_to_text(audio):
+    segments, _ = model.transcribe(audio, language="ar")
+    return " ".join(seg.text.strip() for seg in segments).strip()
+
+# الأسئلة مطبّعة مرة واحدة عند التشغيل (بدون تشكيل، مع توحيد الألف والياء)
+qa_normalized = {normalize_arabic(q): a for q, a in qa_data.items()}
+qa_automaton = build_automaton(qa_normalized.items())
 
-# البحث عن الجواب
+# البحث عن الجواب: تطابق كامل من القاموس مباشرة، وإلا أول سؤال معروف يظهر داخل الكلام
 def get_answer(question):
-    for q, a in qa_data.items():
-        if q in question:
-            return a
-    return None
+    key = normalize_arabic(question)
+    if key in qa_normalized:
+        return qa_normalized[key]
+    return first_match(qa_automaton, key)
 
-# تحويل النص إلى صوت باستخدام gTTS وتشغيله مباشرة على Windows
+# صوت Piper محلي اختياري (PIPER_VOICE=مسار ملف .onnx، يتطلب pip install piper-tts)
+# يولّد PCM يُشغَّل مباشرة عبر sounddevice، بدون MP3 على القرص ولا مشغّل خارجي
+piper_voice = None
+piper_voice_path = os.getenv("PIPER_VOICE")
+if piper_voice_path:
+    try:
+        from piper import PiperVoice
+        piper_voice = PiperVoice.load(piper_voice_path)
+    except Exception as e:
+        print(f"⚠️ تعذّر تحميل صوت Piper، سيتم استخدام gTTS: {e}")
+
+# تحويل النص إلى صوت وتشغيله: Piper إن وُجد، وإلا gTTS مع مشغّل Windows
 def text_to_speech(text):
+    if piper_voice:
+        # كل جملة تُكتب إلى السماعة فور توليدها، فيبدأ الكلام قبل اكتمال تحويل النص كله
+        # (إغلاق الـ stream ينتظر انتهاء تشغيل ما تبقى في المخزن)
+        with sd.OutputStream(samplerate=piper_voice.config.sample_rate, channels=1, dtype="int16") as stream:
+            for chunk in piper_voice.synthesize(text):
+                stream.write(np.frombuffer(chunk.audio_int16_bytes, dtype=np.int16))
+        return
+
     temp_path = os.path.join(os.getcwd(), "temp_audio.mp3")
     tts = gTTS(text=text, lang="ar")
     tts.save(temp_path)
@@ -47,11 +101,9 @@ def text_to_speech(text):
 
 # البرنامج الرئيسي
 def main():
-    temp_audio_path = os.path.join(os.getcwd(), "temp_record.wav")
-    record_audio(temp_audio_path, duration=6)
-    text = speech_to_text(temp_audio_path)
-    os.remove(temp_audio_path)
-    
+    audio = record_audio()
+    text = speech_to_text(audio)
+
     print("📝 النص المستخرج:", text)
 
     if text == "" or text.isspace():
@@ -0,0 +1,16 @@
+# تحويل نموذج Whisper إلى صيغة CTranslate2 مكمّمة (خطوة تُنفَّذ مرة واحدة وقت البناء)
+# الاستخدام: python convert_model.py [openai/whisper-small] [int8_float32]
+# يتطلب: pip install ctranslate2 transformers torch
+# app.py يحمّل models/whisper-small-int8_float32 تلقائياً إن وُجد؛ لغيره: WHISPER_MODEL=models/<المجلد> python app.py
+import os
+import sys
+from ctranslate2.converters import TransformersConverter
+
+model_id = sys.argv[1] if len(sys.argv) > 1 else "openai/whisper-small"
+# CTranslate2 لا يدعم تكميم 4-بت على المعالج، لذا أصغر صيغة متاحة هي int8
+quantization = sys.argv[2] if len(sys.argv) > 2 else "int8_float32"
+output_dir = os.path.join("models", f"{model_id.split('/')[-1]}-{quantization}")
+
+converter = TransformersConverter(model_id, copy_files=["tokenizer.json", "preprocessor_config.json"])
+converter.convert(output_dir, quantization=quantization, force=True)
+print("تم حفظ النموذج في:", output_dir)
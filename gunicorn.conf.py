@@ -0,0 +1,12 @@
+# إعدادات gunicorn للإنتاج (Procfile: gunicorn -c gunicorn.conf.py app:app)
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+# عامل واحد بعدة خيوط: الطلبات تتداخل أثناء انتظار Gemini و TTS، ومجمّعات الخيوط في app.py تحدّ عمل المعالج
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+worker_class = "gthread"
+# بدون preload_app عمداً: كل عامل يستورد app.py ويبني نموذج Whisper بنفسه، لأن خيوط CTranslate2
+# وسياق CUDA ونموذج OpenVINO المترجم لا تنجو من fork فيتجمّد التفريغ في العمّال
+# التفريغ على المعالج قد يستغرق عشرات الثواني للتسجيلات الطويلة
+timeout = 120
@@ -1,11 +1,11 @@
-import whisper
+from faster_whisper import WhisperModel
 
 # تحميل نموذج Whisper
-model = whisper.load_model("base")
+model = WhisperModel("base", device="cpu", compute_type="int8")
 
 # تحويل الصوت إلى نص
-result = model.transcribe("test.mp3")
+segments, _ = model.transcribe("test.mp3")
 
 # عرض النص المستخرج
 print("النص المكتشف:")
-print(result["text"])
+print(" ".join(seg.text.strip() for seg in segments))
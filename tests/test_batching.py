@@ -0,0 +1,139 @@
+import importlib
+import io
+import logging
+import re
+import sys
+import wave
+
+import numpy as np
+import pytest
+from ctranslate2.specs import whisper_spec
+from tokenizers import Regex, Tokenizer, decoders, models, pre_tokenizers
+
+
+def build_tiny_whisper(out, d=64, layers=2, heads=2, seed=2):
+    # نموذج Whisper عشوائي صغير بصيغة CTranslate2: مخرجاته بلا معنى لكنها حتمية مع فك الترميز الجشع
+    rng = np.random.default_rng(seed)
+    chars = list(" abcdefghijklmnopqrstuvwxyz.,?!'-\"") + list("ابتثجحخدذرزسشصضطظعغفقكلمنهوي")
+    specials = ["<|endoftext|>", "<|startoftranscript|>", "<|en|>", "<|translate|>", "<|transcribe|>",
+                "<|startoflm|>", "<|startofprev|>", "<|nospeech|>", "<|notimestamps|>"]
+    specials += [f"<|{i * 0.02:.2f}|>" for i in range(1501)]
+    vocab = ["<unk>"] + chars + specials
+
+    def rand(*shape):
+        return (rng.standard_normal(shape) * 0.2).astype(np.float32)
+
+    def norm(spec):
+        spec.gamma = np.ones(d, np.float32)
+        spec.beta = np.zeros(d, np.float32)
+
+    def linear(spec, out_dim, in_dim, scale=1.0):
+        spec.weight = rand(out_dim, in_dim) * scale
+        spec.bias = np.zeros(out_dim, np.float32)
+
+    def ffn(spec):
+        norm(spec.layer_norm)
+        linear(spec.linear_0, 4 * d, d)
+        linear(spec.linear_1, d, 4 * d)
+
+    spec = whisper_spec.WhisperSpec(layers, heads, layers, heads)
+    encoder = spec.encoder
+    encoder.conv1.weight = rand(d, 80, 3)
+    encoder.conv1.bias = np.zeros(d, np.float32)
+    encoder.conv2.weight = rand(d, d, 3)
+    encoder.conv2.bias = np.zeros(d, np.float32)
+    encoder.position_encodings.encodings = rand(1500, d)
+    norm(encoder.layer_norm)
+    for layer in encoder.layer:
+        norm(layer.self_attention.layer_norm)
+        linear(layer.self_attention.linear[0], 3 * d, d)
+        linear(layer.self_attention.linear[1], d, d)
+        ffn(layer.ffn)
+    decoder = spec.decoder
+    decoder.embeddings.weight = rand(len(vocab), d)
+    decoder.position_encodings.encodings = rand(448, d)
+    norm(decoder.layer_norm)
+    # إسقاط كبير يجعل الاختيار الجشع واثقاً، فلا يلجأ transcribe إلى temperature fallback العشوائي
+    linear(decoder.projection, len(vocab), d, scale=5.0)
+    for layer in decoder.layer:
+        norm(layer.self_attention.layer_norm)
+        linear(layer.self_attention.linear[0], 3 * d, d)
+        linear(layer.self_attention.linear[1], d, d)
+        norm(layer.attention.layer_norm)
+        linear(layer.attention.linear[0], d, d)
+        linear(layer.attention.linear[1], 2 * d, d)
+        linear(layer.attention.linear[2], d, d)
+        ffn(layer.ffn)
+    spec.register_vocabulary(vocab)
+    spec.validate()
+    spec.optimize(quantization="int8")
+    spec.save(str(out))
+
+    tokenizer = Tokenizer(models.WordLevel({token: i for i, token in enumerate(vocab)}, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split(Regex("."), behavior="isolated")
+    tokenizer.decoder = decoders.Fuse()
+    tokenizer.add_special_tokens(specials)
+    tokenizer.save(str(out / "tokenizer.json"))
+    return out
+
+
+def speechlike_wav(seconds, seed, sr=16000):
+    # مقاطع صوتية بنغمة أساسية وترددات رنين الحروف المتحركة، يعدّها Silero VAD كلاماً فلا يحذفها
+    rng = np.random.default_rng(seed)
+    vowels = [(730, 1090, 2440), (270, 2290, 3010), (300, 870, 2240), (530, 1840, 2480), (570, 840, 2410)]
+    parts = []
+    while sum(map(len, parts)) < seconds * sr:
+        n = int(sr * rng.uniform(0.15, 0.3))
+        t = np.arange(n) / sr
+        f0 = rng.uniform(110, 160) * (1 + 0.05 * np.sin(2 * np.pi * 3 * t))
+        pulses = (np.sin(2 * np.pi * np.cumsum(f0) / sr) > 0.9) + 0.01 * rng.standard_normal(n)
+        freqs = np.fft.rfftfreq(n, 1 / sr)
+        gain = sum(1 / (1 + ((freqs - fc) / 80) ** 2) for fc in vowels[rng.integers(len(vowels))])
+        parts.append(np.fft.irfft(np.fft.rfft(pulses) * gain, n) * np.hanning(n))
+        parts.append(np.zeros(int(sr * rng.uniform(0.02, 0.08))))
+    audio = np.concatenate(parts)[: seconds * sr]
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sr)
+        w.writeframes((audio / np.abs(audio).max() * 0.5 * 32767).astype("<i2").tobytes())
+    return buf.getvalue()
+
+
+@pytest.fixture(scope="module")
+def app_module(tmp_path_factory):
+    model_dir = build_tiny_whisper(tmp_path_factory.mktemp("whisper"))
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("WHISPER_MODEL", str(model_dir))
+        mp.setenv("WHISPER_DEVICE", "cpu")
+        mp.setenv("WHISPER_WORKERS", "4")
+        mp.setenv("WHISPER_WARMUP", "0")
+        mp.setenv("WHISPER_BATCH", "1")
+        mp.setenv("WHISPER_BATCH_WINDOW_MS", "500")
+        mp.delenv("WHISPER_OV_ENCODER", raising=False)
+        mp.delenv("PIPER_VOICE", raising=False)
+        mp.delenv("GEMINI_API_KEY", raising=False)
+        mp.chdir(tmp_path_factory.mktemp("cwd"))
+        sys.modules.pop("app", None)
+        yield importlib.import_module("app")
+        sys.modules.pop("app", None)
+
+
+def test_batched_encoder_matches_transcribe_until_med(app_module, monkeypatch, caplog):
+    # 40 ثانية تعطي أكثر من نافذة Whisper واحدة
+    clips = [speechlike_wav(seconds, seed) for seconds, seed in [(3, 3), (8, 8), (12, 12), (40, 40)]]
+
+    # المرجع: نفس transcribe_until_med بالمُرمِّز الأصلي بدون تجميع
+    monkeypatch.delattr(app_module.get_whisper(), "encode")
+    expected = [app_module.transcribe_until_med(io.BytesIO(clip)) for clip in clips]
+    monkeypatch.undo()
+    assert any(text for text, _, _ in expected)
+
+    with caplog.at_level(logging.INFO, logger="voice-bot"):
+        futures = [app_module.whisper_pool.submit(app_module.transcribe_until_med, io.BytesIO(clip)) for clip in clips]
+        results = [future.result(timeout=300) for future in futures]
+
+    assert results == expected
+    batch_sizes = [int(m.group(1)) for m in re.finditer(r"Encoded a batch of (\d+)", caplog.text)]
+    assert max(batch_sizes) > 1
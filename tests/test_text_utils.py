@@ -0,0 +1,28 @@
+from text_utils import iter_sentences, normalize_arabic, split_sentences
+
+
+def test_split_keeps_decimal_doses_together():
+    assert split_sentences("خذ 2.5 ملغ مرتين. ثم 0.5 ملغ مساءً.") == ["خذ 2.5 ملغ مرتين.", " ثم 0.5 ملغ مساءً."]
+
+
+def test_split_on_arabic_question_mark_and_newline():
+    assert split_sentences("هل تأخذ الدواء؟ نعم\nشكراً") == ["هل تأخذ الدواء؟", " نعم\n", "شكراً"]
+
+
+def test_split_round_trips_text():
+    text = "الجرعة 1.25 ملغ. بعد الأكل!\nلا تتجاوز 2.5 ملغ؟ حسناً"
+    assert "".join(split_sentences(text)) == text
+
+
+def test_iter_sentences_decimal_split_across_chunks():
+    # نقطة في آخر الدفعة قد تكون فاصلة عشرية تكمل في الدفعة التالية
+    chunks = ["خذ 2", ".", "5 ملغ", ". بعد", " الأكل"]
+    assert list(iter_sentences(chunks)) == ["خذ 2.5 ملغ.", " بعد الأكل"]
+
+
+def test_iter_sentences_flushes_trailing_terminator():
+    assert list(iter_sentences(["الجرعة 0.5 ملغ."])) == ["الجرعة 0.5 ملغ."]
+
+
+def test_normalize_arabic_strips_diacritics_and_unifies_letters():
+    assert normalize_arabic("  أَسْبِرِين  إِبُوبْرُوفِين ") == "اسبرين ابوبروفين"
@@ -0,0 +1,59 @@
+# text_utils.py: تطبيع النص العربي والبحث متعدد الأنماط، مشترك بين app.py و bot.py
+import re
+import functools
+import unicodedata
+import ahocorasick
+
+# ---------------- دوال تطبيع النص العربي ----------------
+# جدول واحد يحذف التشكيل ويوحّد أشكال الحروف في مرور واحد على النص (str.translate بلغة C)
+ARABIC_DIACRITICS = [(0x0610, 0x061A), (0x064B, 0x065F), (0x0670, 0x0670), (0x06D6, 0x06ED)]
+_ARABIC_TRANS = {cp: None for lo, hi in ARABIC_DIACRITICS for cp in range(lo, hi + 1)}
+_ARABIC_TRANS.update(str.maketrans({"آ": "ا", "أ": "ا", "إ": "ا", "ى": "ي", "ؤ": "و", "ئ": "ي"}))
+_PUNCT_RE = re.compile(r"[^\w\s\u0600-\u06FF]")
+
+@functools.lru_cache(maxsize=4096)
+def normalize_arabic(text: str) -> str:
+    if not text:
+        return ""
+    # NFKC يحوّل أشكال العرض العربية (مثل ﻻ و ﺍ) إلى الحروف الأساسية قبل التوحيد
+    text = unicodedata.normalize("NFKC", text).lower().translate(_ARABIC_TRANS)
+    text = _PUNCT_RE.sub(" ", text)
+    # split/join يجمع المسافات المتتالية ويحذف الأطراف بدون regex إضافي
+    return " ".join(text.split())
+
+# ---------------- البحث متعدد الأنماط (Aho-Corasick) ----------------
+def build_automaton(items):
+    # items: أزواج (نص مطبّع، قيمة)؛ أول قيمة تحتفظ بالنص عند التكرار
+    automaton = ahocorasick.Automaton()
+    for norm, value in items:
+        if norm and not automaton.exists(norm):
+            automaton.add_word(norm, value)
+    if len(automaton):
+        automaton.make_automaton()
+    return automaton
+
+def first_match(automaton, norm_text: str):
+    # مرور واحد على النص؛ iter_long يعطي أطول تطابق من اليسار، فلا يغلب نمط قصير هو بداية نمط أطول
+    if automaton.kind == ahocorasick.AHOCORASICK:
+        for _, value in automaton.iter_long(norm_text):
+            return value
+    return None
+
+# ---------------- تقسيم الجمل ----------------
+# النقطة تُنهي الجملة فقط إذا تبعتها مسافة، فلا تنقسم الأرقام العشرية مثل "2.5 ملغ" إلى "2." و "5 ملغ".
+# كل الفواصل بعرض صفري، فـ "".join يعيد النص كما هو
+SENTENCE_END_RE = re.compile(r"(?<=[.?!؟۔])(?=\s)|(?<=\n)")
+
+def split_sentences(text: str) -> list:
+    return [s for s in SENTENCE_END_RE.split(text) if s]
+
+def iter_sentences(chunks):
+    # chunks: نص يصل على دفعات (مثل تدفق Gemini). آخر جزء يبقى في المخزن حتى تصل بقية الدفعات،
+    # لأن نقطة في آخر الدفعة قد تكون فاصلة عشرية تكمل في الدفعة التالية
+    buf = ""
+    for chunk in chunks:
+        buf += chunk
+        *done, buf = SENTENCE_END_RE.split(buf)
+        yield from (s for s in done if s)
+    if buf:
+        yield buf